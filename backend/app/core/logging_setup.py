@@ -0,0 +1,19 @@
+import logging
+import logging.handlers
+import queue
+
+
+def setup_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """Route log records through a queue so the actual writes happen on a background thread"""
+    log_queue: queue.Queue = queue.Queue(-1)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
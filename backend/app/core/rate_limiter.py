@@ -0,0 +1,33 @@
+import time
+from collections import deque
+
+
+class SlidingWindow:
+    """In-memory sliding-window counter over a ring of fixed time slices"""
+
+    __slots__ = ("limit", "slice_seconds", "slices", "total", "current")
+
+    def __init__(self, limit: int, window_seconds: float, slice_count: int = 10):
+        self.limit = limit
+        self.slice_seconds = window_seconds / slice_count
+        self.slices = deque([0] * slice_count, maxlen=slice_count)
+        # Running sum of all slices, so a check never has to add them up
+        self.total = 0
+        self.current = int(time.monotonic() // self.slice_seconds)
+
+    def take(self, amount: int = 1, now: float = None) -> bool:
+        """Count amount against the window if it stays within the limit"""
+        now = now if now is not None else time.monotonic()
+        tick = int(now // self.slice_seconds)
+
+        # Expire the slices that slid out of the window since the last check
+        for _ in range(min(tick - self.current, len(self.slices))):
+            self.total -= self.slices[0]
+            self.slices.append(0)
+        self.current = max(self.current, tick)
+
+        if self.total + amount > self.limit:
+            return False
+        self.slices[-1] += amount
+        self.total += amount
+        return True
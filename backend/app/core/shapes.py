@@ -1,6 +1,7 @@
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 import math
+import numpy as np
 
 
 @dataclass
@@ -65,8 +66,38 @@ class GeometryUtils:
 
 
 class EraserEngine:
+    # Stroke/eraser point pairs compared per NumPy slice
+    MAX_PAIRS = 1 << 20
+
     def __init__(self):
         self.eraser_width = 20  # Default eraser width
+
+    def _cut_mask(self, stroke_points: List[Tuple[float, float]],
+                  eraser_path: List[Tuple[float, float]]) -> np.ndarray:
+        """Flag every stroke point that lies within eraser range of the path"""
+        stroke_xy = np.asarray(stroke_points, dtype=np.float64)[:, :2]
+        eraser_xy = np.asarray(eraser_path, dtype=np.float64)[:, :2]
+        width = self.eraser_width
+        mask = np.zeros(len(stroke_xy), dtype=bool)
+
+        # Broad phase: only points inside the path's padded bounding box can be hit
+        low = eraser_xy.min(axis=0) - width
+        high = eraser_xy.max(axis=0) + width
+        candidates = np.flatnonzero(((stroke_xy >= low) & (stroke_xy <= high)).all(axis=1))
+
+        # Squared distances to every eraser point, in slices to bound memory
+        step = max(1, self.MAX_PAIRS // len(eraser_xy))
+        for i in range(0, len(candidates), step):
+            idx = candidates[i:i + step]
+            d2 = ((stroke_xy[idx, None, :] - eraser_xy[None, :, :]) ** 2).sum(axis=-1)
+            mask[idx] = (d2 <= width * width).any(axis=1)
+        return mask
+    
+    def hits(self, stroke_xy: np.ndarray, eraser_xy: np.ndarray) -> bool:
+        """Check whether the eraser path touches any point of a stroke, both as (n, 2) arrays"""
+        if not len(stroke_xy) or not len(eraser_xy):
+            return False
+        return bool(self._cut_mask(stroke_xy, eraser_xy).any())
     
     def cut_stroke(self, stroke_points: List[Tuple[float, float]], 
                    eraser_path: List[Tuple[float, float]]) -> List[List[Tuple[float, float]]]:
@@ -74,20 +105,15 @@ class EraserEngine:
         if not stroke_points or not eraser_path:
             return [stroke_points]
         
+        # Hit test every point at once; only the segmenting stays in Python
+        cut_mask = self._cut_mask(stroke_points, eraser_path).tolist()
+        
         segments = []
         current_segment = []
         
-        for point in stroke_points:
+        for point, should_cut in zip(stroke_points, cut_mask):
             current_segment.append(point)
             
-            # Check if this point is near eraser path
-            should_cut = False
-            for eraser_point in eraser_path:
-                if GeometryUtils.point_distance(point[0], point[1], 
-                                              eraser_point[0], eraser_point[1]) <= self.eraser_width:
-                    should_cut = True
-                    break
-            
             if should_cut and len(current_segment) > 1:
                 if current_segment:  # Don't add empty segments
                     segments.append(current_segment[:-1])  # Exclude the intersecting point
@@ -97,3 +123,91 @@ class EraserEngine:
             segments.append(current_segment)
         
         return segments
+
+
+class PointBuffer:
+    """A stroke's xy points in one float64 array grown by doubling; only [:count] is valid"""
+    INITIAL_CAPACITY = 64
+
+    __slots__ = ("xy", "count")
+
+    def __init__(self):
+        self.xy = np.empty((self.INITIAL_CAPACITY, 2), dtype=np.float64)
+        self.count = 0
+
+    def _grow(self, needed: int):
+        """Double the capacity until needed points fit"""
+        capacity = len(self.xy)
+        while capacity < needed:
+            capacity *= 2
+        xy = np.empty((capacity, 2), dtype=np.float64)
+        xy[:self.count] = self.xy[:self.count]
+        self.xy = xy
+
+    def extend(self, xy: np.ndarray):
+        """Append an (n, 2) block of points in one copy"""
+        end = self.count + len(xy)
+        if end > len(self.xy):
+            self._grow(end)
+        self.xy[self.count:end] = xy
+        self.count = end
+
+    def view(self) -> np.ndarray:
+        """The valid points, without copying"""
+        return self.xy[:self.count]
+
+
+class StrokeIndex:
+    """Uniform grid over a board's stroke points, to find strokes near a path"""
+    CELL_SIZE = 64
+
+    def __init__(self):
+        self.strokes: Dict[str, PointBuffer] = {}
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return (math.floor(x / self.CELL_SIZE), math.floor(y / self.CELL_SIZE))
+
+    def _cells(self, xy: np.ndarray) -> Set[Tuple[int, int]]:
+        """Grid cells holding any of the given points"""
+        return set(map(tuple, np.floor(xy / self.CELL_SIZE).astype(np.int64).tolist()))
+
+    def add(self, stroke_id: str, points: List[Tuple[float, float]]):
+        """Index more points of a stroke"""
+        if not points:
+            return
+        xy = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        buffer = self.strokes.get(stroke_id)
+        if buffer is None:
+            buffer = self.strokes[stroke_id] = PointBuffer()
+        buffer.extend(xy)
+        for cell in self._cells(xy):
+            self.cells.setdefault(cell, set()).add(stroke_id)
+
+    def points(self, stroke_id: str) -> np.ndarray:
+        """A stroke's indexed points as an (n, 2) array view"""
+        return self.strokes[stroke_id].view()
+
+    def remove(self, stroke_id: str):
+        """Drop a stroke and all its points"""
+        buffer = self.strokes.pop(stroke_id, None)
+        if buffer is None:
+            return
+        for cell in self._cells(buffer.view()):
+            ids = self.cells.get(cell)
+            if ids is not None:
+                ids.discard(stroke_id)
+                if not ids:
+                    del self.cells[cell]
+
+    def near(self, path: List[Tuple[float, float]], radius: float) -> Set[str]:
+        """Ids of strokes with a point in a cell within radius of the path"""
+        cells = set()
+        for x, y in path:
+            x0, y0 = self._cell(x - radius, y - radius)
+            x1, y1 = self._cell(x + radius, y + radius)
+            cells.update((cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1))
+        found = set()
+        for cell in cells:
+            found.update(self.cells.get(cell, ()))
+        return found
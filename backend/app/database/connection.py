@@ -1,10 +1,13 @@
 # connection.py - UPDATED VERSION
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, Session
 from contextlib import contextmanager
 from .models import Base
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 # Database file path
 DB_PATH = os.path.join(os.path.dirname(__file__), "../../drawing_app.db")
 DATABASE_URL = f"sqlite:///{DB_PATH}"
@@ -13,17 +16,41 @@ DATABASE_URL = f"sqlite:///{DB_PATH}"
 engine = create_engine(
     DATABASE_URL,
     connect_args={"check_same_thread": False},
+    # A fixed set of connections is reused instead of reopening the file.
+    # Loop code never holds a session across an await and the executor has
+    # 4 threads, so this many never run out; if they do, fail fast instead
+    # of blocking the event loop for the default 30 s
+    pool_size=8,
+    max_overflow=0,
+    pool_timeout=2,
     echo=False
 )
 
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    """Per-connection SQLite settings for WAL-mode access"""
+    cursor = dbapi_connection.cursor()
+    # WAL only needs an fsync at checkpoints; wait on a locked database
+    # instead of failing, and keep temp tables and reads in memory
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
 def init_db():
     """Initialize database tables"""
+    # WAL lets readers proceed while a write is in progress; the mode is
+    # stored in the database file, so setting it once is enough
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
     Base.metadata.create_all(bind=engine)
-    print(f"Database initialized at {DB_PATH}")
+    logger.info("Database initialized at %s", DB_PATH)
 
 
 def get_db() -> Session:
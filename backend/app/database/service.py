@@ -1,6 +1,8 @@
+from sqlalchemy import func, insert
 from sqlalchemy.orm import Session
 from .models import ActiveConnection, AdminTimer, Board, ConnectionState, RateLimit, User, Stroke, StrokePoint, Shape, TextObject, Layer, BannedToken, Timeout, UserToken
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
+from collections import Counter
 import time
 
 class DatabaseService:
@@ -111,6 +113,74 @@ class DatabaseService:
         
         db.commit()
     
+    @staticmethod
+    def write_batch(db: Session, strokes: List[Dict],
+                    stroke_points: List[Tuple[str, List[Dict]]],
+                    cursors: Dict[Tuple[str, str], Tuple[float, float, str]]):
+        """Persist a batch of queued drawing writes in a single commit"""
+        now = time.time()
+        if strokes:
+            db.execute(insert(Stroke), strokes)
+            # Count new strokes against their boards in the same commit
+            for board_id, count in Counter(s["board_id"] for s in strokes).items():
+                db.query(Board).filter(Board.board_id == board_id).update(
+                    {Board.object_count: Board.object_count + count},
+                    synchronize_session=False
+                )
+        
+        if stroke_points:
+            # Continue point_order from what is already stored for each stroke
+            stroke_ids = {stroke_id for stroke_id, _ in stroke_points}
+            next_order = dict(
+                db.query(StrokePoint.stroke_id, func.count(StrokePoint.id))
+                .filter(StrokePoint.stroke_id.in_(stroke_ids))
+                .group_by(StrokePoint.stroke_id)
+                .all()
+            )
+            rows = []
+            for stroke_id, points in stroke_points:
+                order = next_order.get(stroke_id, 0)
+                for point in points:
+                    rows.append({
+                        "stroke_id": stroke_id,
+                        "x": point["x"],
+                        "y": point["y"],
+                        "pressure": point.get("pressure", 0.5),
+                        "timestamp": point.get("timestamp", now),
+                        "point_order": order
+                    })
+                    order += 1
+                next_order[stroke_id] = order
+            if rows:
+                db.execute(insert(StrokePoint), rows)
+        
+        # Cursor activity also counts as a connection heartbeat
+        for (board_id, user_id), (x, y, tool) in cursors.items():
+            db.query(ActiveConnection).filter(
+                ActiveConnection.board_id == board_id,
+                ActiveConnection.user_id == user_id
+            ).update({ActiveConnection.last_heartbeat: now})
+            
+            state = db.query(ConnectionState).filter(
+                ConnectionState.board_id == board_id,
+                ConnectionState.user_id == user_id
+            ).first()
+            if not state:
+                db.add(ConnectionState(
+                    board_id=board_id,
+                    user_id=user_id,
+                    cursor_x=x,
+                    cursor_y=y,
+                    active_tool=tool
+                ))
+            else:
+                state.cursor_x = x
+                state.cursor_y = y
+                state.active_tool = tool
+                state.last_activity = now
+        
+        db.commit()
+    
     @staticmethod
     def add_shape(db: Session, shape_id: str, board_id: str, shape_data: Dict) -> Shape:
         """Add a new shape"""
@@ -182,15 +252,47 @@ class DatabaseService:
         return deleted
     
     @staticmethod
-    def get_board_state(db: Session, board_id: str) -> Dict:
-        """Get complete board state"""
+    def delete_strokes(db: Session, board_id: str, stroke_ids: List[str]) -> int:
+        """Delete several strokes of a board and their points in one commit"""
+        if not stroke_ids:
+            return 0
+        
+        board_strokes = db.query(Stroke.stroke_id).filter(
+            Stroke.board_id == board_id,
+            Stroke.stroke_id.in_(stroke_ids)
+        )
+        db.query(StrokePoint).filter(
+            StrokePoint.stroke_id.in_(board_strokes.scalar_subquery())
+        ).delete(synchronize_session=False)
+        deleted = db.query(Stroke).filter(
+            Stroke.board_id == board_id,
+            Stroke.stroke_id.in_(stroke_ids)
+        ).delete(synchronize_session=False)
+        
+        board = DatabaseService.get_board(db, board_id)
+        if board:
+            board.object_count = max(0, board.object_count - deleted)
+        db.commit()
+        return deleted
+    
+    @staticmethod
+    def get_stroke_points(db: Session, board_id: str) -> Dict[str, List[Tuple[float, float]]]:
+        """Get the coordinates of every stroke point on a board, keyed by stroke id"""
+        rows = db.query(StrokePoint.stroke_id, StrokePoint.x, StrokePoint.y).join(
+            Stroke, Stroke.stroke_id == StrokePoint.stroke_id
+        ).filter(Stroke.board_id == board_id).order_by(StrokePoint.id)
+        points: Dict[str, List[Tuple[float, float]]] = {}
+        for stroke_id, x, y in rows:
+            points.setdefault(stroke_id, []).append((x, y))
+        return points
+
+    @staticmethod
+    def get_board_objects(db: Session, board_id: str) -> Optional[Dict]:
+        """Get strokes, shapes, texts and layers of a board"""
         board = DatabaseService.get_board(db, board_id)
         if not board:
             return None
         
-        # Get users - use the relationship defined in Board
-        users = board.users
-        
         # Get strokes with points
         strokes = board.strokes
         strokes_data = []
@@ -261,6 +363,26 @@ class DatabaseService:
             } for layer in layers
         ]
         
+        return {
+            "strokes": strokes_data,
+            "shapes": shapes_data,
+            "texts": texts_data,
+            "layers": layers_data
+        }
+    
+    @staticmethod
+    def get_board_state(db: Session, board_id: str, objects: Optional[Dict] = None) -> Dict:
+        """Get complete board state, optionally reusing already loaded objects"""
+        board = DatabaseService.get_board(db, board_id)
+        if not board:
+            return None
+        
+        if objects is None:
+            objects = DatabaseService.get_board_objects(db, board_id)
+        
+        # Get users - use the relationship defined in Board
+        users = board.users
+        
         # Check if admin is online
         admin_online = any(u.user_id == board.admin_id and u.connected for u in users)
         
@@ -282,10 +404,10 @@ class DatabaseService:
                     "connected_at": u.connected_at
                 } for u in users
             ],
-            "strokes": strokes_data,
-            "shapes": shapes_data,
-            "texts": texts_data,
-            "layers": layers_data,
+            "strokes": objects["strokes"],
+            "shapes": objects["shapes"],
+            "texts": objects["texts"],
+            "layers": objects["layers"],
             "object_count": board.object_count,
             "max_objects": board.max_objects,
             "max_users": board.max_users,
@@ -404,7 +526,7 @@ class DatabaseService:
         db.commit()
 
     @staticmethod
-    def update_connection_heartbeat(db: Session, board_id: str, user_id: str):
+    def update_connection_heartbeat(db: Session, board_id: str, user_id: str, now: float = None):
         """Update last heartbeat timestamp"""
         connection = db.query(ActiveConnection).filter(
             ActiveConnection.board_id == board_id,
@@ -412,7 +534,7 @@ class DatabaseService:
         ).first()
         
         if connection:
-            connection.last_heartbeat = time.time()
+            connection.last_heartbeat = now or time.time()
             db.commit()
 
     @staticmethod
@@ -439,6 +561,17 @@ class DatabaseService:
         ).all()
         return [conn.user_id for conn in connections]
 
+    @staticmethod
+    def end_board_session(db: Session, board_id: str) -> List[str]:
+        """Deactivate a board and drop its connections, returning the users that were connected"""
+        active_users = DatabaseService.get_active_users(db, board_id)
+        db.query(Board).filter(Board.board_id == board_id).update({Board.is_active: False})
+        db.query(ActiveConnection).filter(
+            ActiveConnection.board_id == board_id
+        ).delete()
+        db.commit()
+        return active_users
+
     @staticmethod
     def cleanup_stale_connections(db: Session, timeout_seconds: int = 30):
         """Remove connections with stale heartbeats"""
@@ -561,13 +694,18 @@ class DatabaseService:
         db.commit()
 
     @staticmethod
-    def update_board_activity(db: Session, board_id: str):
+    def update_board_activity(db: Session, board_id: str, now: float = None):
         """Update board's last activity timestamp"""
         board = DatabaseService.get_board(db, board_id)
         if board:
-            board.last_activity = time.time()
+            board.last_activity = now or time.time()
             db.commit()
 
+    @staticmethod
+    def stroke_exists(db: Session, stroke_id: str) -> bool:
+        """Check whether a stroke id is already stored"""
+        return db.query(Stroke.id).filter(Stroke.stroke_id == stroke_id).first() is not None
+
     @staticmethod
     def increment_object_count(db: Session, board_id: str):
         """Increment board's object count"""
@@ -0,0 +1,34 @@
+import struct
+from typing import List
+
+# Record kinds; a binary frame is one or more records back to back
+STROKE_POINTS = 1
+
+# kind, stroke_id length (the id bytes follow)
+_HEAD = struct.Struct("<BH")
+# user_id length (the id bytes follow)
+_USER = struct.Struct("<H")
+# event timestamp, point count (int16 xs, int16 ys, uint8 pressures follow)
+_BODY = struct.Struct("<dI")
+
+
+def _clamp_int16(value: float) -> int:
+    return min(32767, max(-32768, round(value)))
+
+
+def encode_stroke_points(user_id: str, stroke_id: str, points: List[dict],
+                         timestamp: float) -> bytes:
+    """Pack a stroke_points event with whole-pixel coordinates and 8-bit pressure"""
+    sid = (stroke_id or "").encode()
+    uid = user_id.encode()
+    n = len(points)
+    values = [_clamp_int16(p.get("x", 0)) for p in points]
+    values += [_clamp_int16(p.get("y", 0)) for p in points]
+    values += [min(255, max(0, round(p.get("pressure", 0.5) * 255))) for p in points]
+
+    return b"".join((
+        _HEAD.pack(STROKE_POINTS, len(sid)), sid,
+        _USER.pack(len(uid)), uid,
+        _BODY.pack(timestamp, n),
+        struct.pack(f"<{2 * n}h{n}B", *values),
+    ))
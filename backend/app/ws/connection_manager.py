@@ -1,61 +1,258 @@
-from typing import Dict, Set
+import asyncio
+import logging
+import orjson
+from dataclasses import dataclass, field
+from typing import Collection, Dict, Optional, Set, Tuple, Union
 from fastapi import WebSocket
 
+logger = logging.getLogger(__name__)
+
+
+def encode_message(message: Union[dict, bytes]) -> bytes:
+    """Serialize a message with orjson; already encoded payloads pass through"""
+    if isinstance(message, bytes):
+        return message
+    return orjson.dumps(message)
+
+
+@dataclass
+class Channel:
+    """A WebSocket with its own bounded outbound queue and sender task"""
+    websocket: WebSocket
+    queue: asyncio.Queue
+    task: Optional[asyncio.Task] = None
+    # Messages skipped in a row because the queue was full
+    dropped: int = 0
+    # Client asked for binary frames where a message has a binary form
+    binary: bool = False
+
+
+@dataclass
+class BoardConnections:
+    """All live channels of one board plus the snapshot broadcasts iterate"""
+    channels: Dict[str, Channel] = field(default_factory=dict)
+    # Immutable (user_id, channel) pairs, rebuilt only on connect/disconnect.
+    # Broadcasts iterate this, never channels, so a connect or disconnect
+    # in the middle of a fan-out cannot change what is being iterated
+    snapshot: Tuple[Tuple[str, Channel], ...] = ()
+
+    def refresh(self):
+        self.snapshot = tuple(self.channels.items())
+
+
 class ConnectionManager:
     """Lightweight in-memory manager JUST for WebSocket connections"""
-    
-    def __init__(self):
-        # Store only WebSocket connections
-        self.active_websockets: Dict[str, Dict[str, WebSocket]] = {}
-        
-    async def connect(self, board_id: str, user_id: str, websocket: WebSocket):
+
+    # Messages buffered per client; further messages are skipped while full
+    SEND_QUEUE_SIZE = 64
+    # Consecutive skipped messages before the client is treated as too slow to keep
+    MAX_DROPPED = 256
+    # Recipients queued per fan-out step before yielding to the event loop
+    BROADCAST_BATCH_SIZE = 32
+
+    def __init__(self, redis_url: Optional[str] = None):
+        # Store only WebSocket connections. Everything mutable is kept per
+        # board, so a board's connections can be handled in isolation
+        self.boards: Dict[str, BoardConnections] = {}
+
+        # With Redis, messages are published per board and every worker
+        # delivers them to its own sockets, so boards can span workers
+        self.redis = None
+        # One pattern subscription per worker covers every board
+        self._listener: Optional[asyncio.Task] = None
+        if redis_url:
+            import redis.asyncio as aioredis
+            self.redis = aioredis.from_url(redis_url)
+
+    async def close(self):
+        """Stop the Redis listener and release the Redis connection"""
+        if self._listener:
+            self._listener.cancel()
+        if self.redis is not None:
+            await self.redis.aclose()
+
+    async def connect(self, board_id: str, user_id: str, websocket: WebSocket,
+                      binary: bool = False):
         """Add WebSocket connection"""
-        if board_id not in self.active_websockets:
-            self.active_websockets[board_id] = {}
-        self.active_websockets[board_id][user_id] = websocket
-        
-    async def disconnect(self, board_id: str, user_id: str):
-        """Remove WebSocket connection"""
-        if board_id in self.active_websockets and user_id in self.active_websockets[board_id]:
-            del self.active_websockets[board_id][user_id]
-            # Clean up empty board
-            if not self.active_websockets[board_id]:
-                del self.active_websockets[board_id]
-                
-    async def send_to_user(self, board_id: str, user_id: str, message: dict):
-        """Send message to specific user"""
-        if (board_id in self.active_websockets and 
-            user_id in self.active_websockets[board_id]):
-            try:
-                websocket = self.active_websockets[board_id][user_id]
-                await websocket.send_json(message)
-            except Exception as e:
-                print(f"Error sending to user {user_id}: {e}")
-                await self.disconnect(board_id, user_id)
-                
-    async def broadcast_to_board(self, board_id: str, message: dict, exclude_user: str = None):
-        """Broadcast message to all users in board"""
-        if board_id not in self.active_websockets:
+        if self.redis is not None and (self._listener is None or self._listener.done()):
+            self._listener = asyncio.create_task(self._redis_listener())
+
+        board = self.boards.get(board_id)
+        if board is None:
+            board = self.boards[board_id] = BoardConnections()
+
+        previous = board.channels.get(user_id)
+        if previous and previous.task:
+            previous.task.cancel()
+
+        channel = Channel(websocket, asyncio.Queue(maxsize=self.SEND_QUEUE_SIZE), binary=binary)
+        channel.task = asyncio.create_task(self._sender(board_id, user_id, channel))
+        board.channels[user_id] = channel
+        board.refresh()
+
+    async def disconnect(self, board_id: str, user_id: str) -> int:
+        """Remove WebSocket connection and return how many remain on this worker"""
+        channel = self._remove(board_id, user_id)
+        if channel and channel.task:
+            channel.task.cancel()
+        board = self.boards.get(board_id)
+        return len(board.channels) if board else 0
+
+    def _remove(self, board_id: str, user_id: str, channel: Channel = None) -> Optional[Channel]:
+        """Drop a user's channel, optionally only if it is still the given one"""
+        board = self.boards.get(board_id)
+        if not board or user_id not in board.channels:
+            return None
+        if channel is not None and board.channels[user_id] is not channel:
+            return None
+
+        removed = board.channels.pop(user_id)
+        # Clean up empty board
+        if not board.channels:
+            del self.boards[board_id]
+        else:
+            board.refresh()
+        return removed
+
+    async def _sender(self, board_id: str, user_id: str, channel: Channel):
+        """Write queued messages to one client so slow peers only delay themselves"""
+        try:
+            while True:
+                # orjson output is already UTF-8, so it goes out as a binary frame
+                await channel.websocket.send_bytes(await channel.queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Error sending to user %s: %s", user_id, e)
+            self._remove(board_id, user_id, channel)
+
+    def _enqueue(self, board_id: str, user_id: str, channel: Channel,
+                 payload: bytes) -> bool:
+        """Queue an encoded message for a client, skipping it while the queue is full"""
+        try:
+            channel.queue.put_nowait(payload)
+            channel.dropped = 0
+            return True
+        except asyncio.QueueFull:
+            channel.dropped += 1
+            if channel.dropped < self.MAX_DROPPED:
+                return False
+            logger.warning("Dropping slow client %s on board %s", user_id, board_id)
+            self._remove(board_id, user_id, channel)
+            channel.task.cancel()
+            asyncio.create_task(self._close(channel.websocket))
+            return False
+
+    async def _close(self, websocket: WebSocket):
+        """Close a dropped client's socket so its endpoint runs the normal cleanup"""
+        try:
+            await websocket.close(code=1013, reason="Client too slow")
+        except Exception:
+            pass
+
+    async def send_to_user(self, board_id: str, user_id: str, message: Union[dict, bytes]):
+        """Send message (a dict or a pre-encoded payload) to specific user"""
+        board = self.boards.get(board_id)
+        channel = board.channels.get(user_id) if board else None
+        if channel:
+            self._enqueue(board_id, user_id, channel, encode_message(message))
+        elif self.redis is not None:
+            # The user may be connected to another worker
+            await self._publish(board_id, encode_message(message), to_user=user_id)
+
+    async def broadcast_to_board(self, board_id: str, message: Union[dict, bytes],
+                                 exclude_user: str = None, binary: Optional[bytes] = None,
+                                 exclude_users: Collection[str] = ()):
+        """Broadcast message (a dict or a pre-encoded payload) to all users in board"""
+        # Encode once; every recipient queue shares the same payload
+        await self.broadcast_bytes(
+            board_id, encode_message(message), exclude_user, binary, exclude_users
+        )
+
+    async def broadcast_bytes(self, board_id: str, payload: bytes,
+                              exclude_user: str = None, binary: Optional[bytes] = None,
+                              exclude_users: Collection[str] = ()):
+        """Broadcast an already encoded payload to all users in board"""
+        exclude = tuple(exclude_users)
+        if exclude_user is not None:
+            exclude += (exclude_user,)
+        # Clients that asked for binary frames get the binary form, when given
+        if self.redis is not None:
+            await self._publish(board_id, payload, exclude=exclude, binary=binary)
+        else:
+            await self._deliver(board_id, payload, exclude=exclude, binary=binary)
+
+    async def _publish(self, board_id: str, payload: bytes, to_user: str = None,
+                       exclude: Collection[str] = (), binary: Optional[bytes] = None):
+        """Publish a payload with its addressing on the board's Redis channel"""
+        # Header fields are newline separated: target, comma separated excluded
+        # users and the length of the binary form, which precedes the JSON payload
+        header = f"{to_user or ''}\n{','.join(exclude)}\n{len(binary) if binary else ''}\n"
+        try:
+            await self.redis.publish(
+                f"board:{board_id}", header.encode() + (binary or b"") + payload
+            )
+        except Exception as e:
+            logger.warning("Error publishing to board %s: %s", board_id, e)
+
+    async def _redis_listener(self):
+        """Deliver messages published for any board to its sockets on this worker"""
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.psubscribe("board:*")
+            async for message in pubsub.listen():
+                # Boards without sockets here are skipped before any parsing
+                board_id = message["channel"][len(b"board:"):].decode()
+                if board_id not in self.boards:
+                    continue
+                to_user, exclude, binary_len, body = message["data"].split(b"\n", 3)
+                binary_len = int(binary_len) if binary_len else 0
+                await self._deliver(
+                    board_id, body[binary_len:],
+                    to_user.decode() or None,
+                    tuple(exclude.decode().split(",")) if exclude else (),
+                    body[:binary_len] if binary_len else None
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Redis listener stopped: %s", e)
+        finally:
+            await pubsub.aclose()
+
+    async def _deliver(self, board_id: str, payload: bytes, to_user: str = None,
+                       exclude: Collection[str] = (), binary: Optional[bytes] = None):
+        """Queue a payload for this worker's sockets on a board"""
+        board = self.boards.get(board_id)
+        if not board:
             return
-            
-        disconnected_users = []
-        
-        for user_id, websocket in list(self.active_websockets[board_id].items()):
-            if user_id == exclude_user:
-                continue
-                
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                print(f"Error broadcasting to user {user_id}: {e}")
-                disconnected_users.append(user_id)
-                
-        # Clean up disconnected users
-        for user_id in disconnected_users:
-            await self.disconnect(board_id, user_id)
-            
+
+        if to_user is not None:
+            channel = board.channels.get(to_user)
+            if channel:
+                self._enqueue(board_id, to_user, channel, payload)
+            return
+
+        # Filter excluded users out once so the fan-out loop has no compare for them
+        if not exclude or board.channels.keys().isdisjoint(exclude):
+            targets = board.snapshot
+        else:
+            targets = [
+                (user_id, channel) for user_id, channel in board.snapshot
+                if user_id not in exclude
+            ]
+        for sent, (user_id, channel) in enumerate(targets, 1):
+            if binary is not None and channel.binary:
+                self._enqueue(board_id, user_id, channel, binary)
+            else:
+                self._enqueue(board_id, user_id, channel, payload)
+            # Yield between batches so one large board cannot hold the loop
+            # for its whole fan-out; the snapshot stays valid across the yield
+            if sent % self.BROADCAST_BATCH_SIZE == 0 and sent < len(targets):
+                await asyncio.sleep(0)
+
     def get_connected_users(self, board_id: str) -> Set[str]:
         """Get set of user_ids with active WebSocket connections"""
-        if board_id in self.active_websockets:
-            return set(self.active_websockets[board_id].keys())
+        if board_id in self.boards:
+            return set(self.boards[board_id].channels.keys())
         return set()
@@ -1,44 +1,404 @@
 # websocket_manager.py - UPDATED VERSION
+import asyncio
+import base64
+import itertools
+import logging
+import math
+import os
 import secrets
-import string
+import struct
 import time
-from typing import Optional
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
 from fastapi import WebSocket
-from app.database import get_db, DatabaseService
+from sqlalchemy.exc import IntegrityError
+from app.database import get_db_session, DatabaseService
 from app.database.models import User, UserToken
-from app.ws.connection_manager import ConnectionManager
+from app.core.rate_limiter import SlidingWindow
+from app.core.shapes import EraserEngine, StrokeIndex
+from app.ws.connection_manager import ConnectionManager, encode_message
+from app.ws.binary_frames import encode_stroke_points
+
+logger = logging.getLogger(__name__)
+
+# Client fields of each object type with their defaults
+_STROKE_FIELDS = (
+    ("layer_id", "default"),
+    ("brush_type", "pen"),
+    ("color", "#000000"),
+    ("width", 5),
+)
+_TEXT_FIELDS = (
+    ("text", ""),
+    ("x", 0),
+    ("y", 0),
+    ("color", "#000000"),
+    ("layer_id", "default"),
+    ("font_size", 16),
+    ("font_family", "Arial"),
+)
+
+
+def _mk_stroke(stroke_data: dict) -> dict:
+    """Stroke style fields a client sent, with defaults"""
+    get = stroke_data.get
+    return {key: get(key, default) for key, default in _STROKE_FIELDS}
+
+
+def _mk_shape(shape_data: dict) -> dict:
+    """Shape fields a client sent; camelCase and snake_case keys are accepted"""
+    get = shape_data.get
+    return {
+        "type": get("type"),
+        "start_x": get("startX", get("start_x")),
+        "start_y": get("startY", get("start_y")),
+        "end_x": get("endX", get("end_x")),
+        "end_y": get("endY", get("end_y")),
+        "color": get("color", "#000000"),
+        "stroke_width": get("strokeWidth", get("stroke_width", 5)),
+        "layer_id": get("layer_id", "default")
+    }
+
+
+def _mk_text(text_data: dict) -> dict:
+    """Text object fields a client sent, with defaults"""
+    get = text_data.get
+    return {key: get(key, default) for key, default in _TEXT_FIELDS}
+
+
+def _valid_stroke_id(stroke_id) -> bool:
+    """Client stroke ids are non-empty strings that fit the stroke_id column"""
+    return isinstance(stroke_id, str) and 0 < len(stroke_id) <= 255
+
+
+def _number(value) -> Optional[float]:
+    """A JSON number as a finite float, or None for anything else"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    try:
+        value = float(value)
+    except OverflowError:
+        return None
+    return value if math.isfinite(value) else None
+
+
+def _checked_stroke(stroke: dict) -> Optional[dict]:
+    """Stroke style fields with a number width and string names, or None if any is another type"""
+    width = _number(stroke["width"])
+    if width is None or not all(
+        isinstance(stroke[key], str) for key in ("layer_id", "brush_type", "color")
+    ):
+        return None
+    return {**stroke, "width": width}
+
+
+def _mk_points(points_data, now: float) -> Optional[List[dict]]:
+    """Stroke points a client sent with defaults filled in, or None if any is malformed"""
+    if not isinstance(points_data, list):
+        return None
+    points = []
+    for point in points_data:
+        if not isinstance(point, dict):
+            return None
+        x = _number(point.get("x"))
+        y = _number(point.get("y"))
+        pressure = point.get("pressure")
+        pressure = 0.5 if pressure is None else _number(pressure)
+        timestamp = point.get("timestamp")
+        timestamp = now if timestamp is None else _number(timestamp)
+        if x is None or y is None or pressure is None or timestamp is None:
+            return None
+        points.append({"x": x, "y": y, "pressure": pressure, "timestamp": timestamp})
+    return points
 
 
 class WebSocketManager:
-    def __init__(self):
-        pass
-                
-    async def generate_join_code(self) -> str:
-        """Generate a 6-character alphanumeric code"""
-        alphabet = string.ascii_uppercase + string.digits
+    # Board creation retries when a generated code hits the unique constraint
+    JOIN_CODE_ATTEMPTS = 5
+    # Drawing writes are queued and persisted by a background writer task
+    WRITE_QUEUE_SIZE = 10000
+    WRITE_BATCH_SIZE = 500
+    # Cursor positions are coalesced per user and broadcast at most at 20 Hz
+    CURSOR_FLUSH_INTERVAL = 0.05
+    # Stroke points are held this long per board and sent as one frame
+    EVENT_FLUSH_INTERVAL = 0.012
+    # Each user may draw this many points in any sliding window
+    DRAW_RATE_POINTS = 1000
+    DRAW_RATE_WINDOW = 60
+
+    def __init__(self, cache_state: bool = True):
+        self.write_q: asyncio.Queue = asyncio.Queue(maxsize=self.WRITE_QUEUE_SIZE)
+        self._writer_task: Optional[asyncio.Task] = None
+        # Thread pool the writer commits on, so SQLite never blocks the loop
+        self._db_executor: Optional[Executor] = None
+        self.latest_cursor: Dict[Tuple[str, str], Tuple[float, float, str]] = {}
+        self._cursor_flush: Optional[asyncio.TimerHandle] = None
+        # Strokes/shapes/texts/layers per board for joins, patched as strokes
+        # change and dropped on other mutations. Only safe when this process
+        # sees every mutation, i.e. one worker
+        self.cache_state = cache_state
+        self.state_cache: Dict[str, dict] = {}
+        # Bumped after every change to a board, so a rebuild can tell whether
+        # a write overtook it while it waited on the writer
+        self._state_versions: Dict[str, int] = {}
+        # Broadcasts waiting for the next coalesced frame, per board
+        self.pending_events: Dict[str, List[dict]] = {}
+        self._event_flush: Dict[str, asyncio.TimerHandle] = {}
+        # Running flush tasks, referenced so they are not collected mid-run
+        self._flush_tasks: Set[asyncio.Task] = set()
+        # Drawing rate limits per board and user, kept while the board has users
+        self.draw_limits: Dict[str, Dict[str, SlidingWindow]] = {}
+        # Admin user per board, fixed for the board's lifetime
+        self.admin_ids: Dict[str, str] = {}
+        # Board and user of every stroke started here, kept while the board
+        # has users; points are only accepted from the stroke's own author
+        self.stroke_owners: Dict[str, Tuple[str, str]] = {}
+        # Shape/text ids: a counter behind a random per-process prefix stays
+        # unique across restarts and workers, unlike a millisecond timestamp
+        self._id_prefix = secrets.token_hex(4)
+        self._object_ids = itertools.count(1)
+        self.eraser = EraserEngine()
+        # Stroke points per board for erase hit tests, kept under the same
+        # rule as state_cache; an erase waits while its board's index loads
+        self.erase_indexes: Dict[str, StrokeIndex] = {}
+        self._erase_loads: Dict[str, asyncio.Event] = {}
+
+    def start(self, db_executor: Optional[Executor] = None):
+        """Start the background database writer on the given thread pool"""
+        if self._writer_task is None:
+            self._db_executor = db_executor
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def stop(self):
+        """Stop background tasks and persist anything still queued"""
+        if self._cursor_flush is not None:
+            self._cursor_flush.cancel()
+            self._cursor_flush = None
+        for handle in self._event_flush.values():
+            handle.cancel()
+        self._event_flush.clear()
+        self.pending_events.clear()
+        # Let running flushes finish while the writer still drains their writes
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
         
-        for db in get_db():
+        if self._writer_task is not None:
+            for (board_id, user_id), (x, y, tool) in self.latest_cursor.items():
+                await self.write_q.put(("cursor", board_id, user_id, x, y, tool))
+            self.latest_cursor.clear()
+            # Cancelling mid-batch would leave its thread writing behind us
+            await self.write_q.join()
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        
+        batch = []
+        while not self.write_q.empty():
+            batch.append(self.write_q.get_nowait())
+            self.write_q.task_done()
+        for (board_id, user_id), (x, y, tool) in self.latest_cursor.items():
+            batch.append(("cursor", board_id, user_id, x, y, tool))
+        self.latest_cursor.clear()
+        if batch:
+            for item in self._write_batch(batch):
+                self._write_dropped(item)
+
+    async def _writer_loop(self):
+        """Drain queued writes and persist them in batches"""
+        while True:
+            batch = [await self.write_q.get()]
+            while len(batch) < self.WRITE_BATCH_SIZE and not self.write_q.empty():
+                batch.append(self.write_q.get_nowait())
             try:
-                while True:
-                    code = ''.join(secrets.choice(alphabet) for _ in range(6))
-                    if not DatabaseService.get_board(db, code):
-                        return code
+                dropped = await asyncio.get_running_loop().run_in_executor(
+                    self._db_executor, self._write_batch, batch
+                )
+                for item in dropped:
+                    self._write_dropped(item)
+            except Exception as e:
+                logger.exception("Error writing drawing batch: %s", e)
             finally:
-                db.close()
-        return None
+                for _ in batch:
+                    self.write_q.task_done()
+
+    def _spawn_flush(self, coro):
+        """Run a flush as a task that is kept referenced until it finishes"""
+        task = asyncio.create_task(coro)
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Flush task failed", exc_info=task.exception())
+
+    def _queue_event(self, board_id: str, event: dict, conn_manager: ConnectionManager):
+        """Hold a broadcast until the board's next coalesced frame"""
+        self.pending_events.setdefault(board_id, []).append(event)
+        if board_id not in self._event_flush:
+            self._event_flush[board_id] = asyncio.get_running_loop().call_later(
+                self.EVENT_FLUSH_INTERVAL,
+                lambda: self._spawn_flush(self._flush_events(board_id, conn_manager))
+            )
+
+    async def _flush_events(self, board_id: str, conn_manager: ConnectionManager):
+        """Broadcast a board's held events, batched into one multi frame"""
+        handle = self._event_flush.pop(board_id, None)
+        if handle:
+            handle.cancel()
+        events = self.pending_events.pop(board_id, None)
+        if not events:
+            return
+        
+        # Binary clients get the points packed as consecutive records. Each
+        # event is encoded on its own so one bad event does not cost the batch
+        binary = None
+        if all(e["type"] == "stroke_points" for e in events):
+            records = []
+            kept = []
+            for e in events:
+                try:
+                    records.append(encode_stroke_points(
+                        e["user_id"], e["stroke_id"], e["points"], e["timestamp"]
+                    ))
+                except (TypeError, ValueError, OverflowError, struct.error) as exc:
+                    logger.warning("Dropping stroke_points for stroke %r: %s", e["stroke_id"], exc)
+                    continue
+                kept.append(e)
+            events = kept
+            if not events:
+                return
+            binary = b"".join(records)
+        
+        if len(events) == 1:
+            await conn_manager.broadcast_to_board(board_id, events[0], binary=binary)
+        else:
+            await conn_manager.broadcast_to_board(
+                board_id, {"type": "multi", "events": events}, binary=binary
+            )
+
+    def _schedule_cursor_flush(self, conn_manager: ConnectionManager):
+        """Arm the cursor flush timer unless one is already pending"""
+        if self._cursor_flush is None:
+            self._cursor_flush = asyncio.get_running_loop().call_later(
+                self.CURSOR_FLUSH_INTERVAL,
+                lambda: self._spawn_flush(self._flush_cursors(conn_manager))
+            )
+
+    async def _flush_cursors(self, conn_manager: ConnectionManager):
+        """Broadcast the latest cursor of every user that moved since the last flush"""
+        self._cursor_flush = None
+        pending, self.latest_cursor = self.latest_cursor, {}
+        try:
+            by_board: Dict[str, list] = {}
+            for (board_id, user_id), (x, y, tool) in pending.items():
+                by_board.setdefault(board_id, []).append({
+                    "user_id": user_id,
+                    "x": x,
+                    "y": y,
+                    "tool": tool
+                })
+                await self.write_q.put(("cursor", board_id, user_id, x, y, tool))
+            
+            now = time.time()
+            for board_id, cursors in by_board.items():
+                movers = [cursor["user_id"] for cursor in cursors]
+                # Users who did not move share one frame with every cursor
+                await conn_manager.broadcast_to_board(board_id, {
+                    "type": "cursor_batch",
+                    "cursors": cursors,
+                    "timestamp": now
+                }, exclude_users=movers)
+                # Movers get the others' cursors but never their own back
+                if len(cursors) > 1:
+                    for i, mover in enumerate(movers):
+                        await conn_manager.send_to_user(board_id, mover, {
+                            "type": "cursor_batch",
+                            "cursors": cursors[:i] + cursors[i + 1:],
+                            "timestamp": now
+                        })
+        except Exception as e:
+            logger.exception("Error flushing cursor updates: %s", e)
+
+    def _write_batch(self, batch: list) -> list:
+        """Persist queued writes in one commit, or one by one if the batch fails"""
+        # Runs on an executor thread; the dropped writes go back to the loop
+        try:
+            self._persist(batch)
+            return []
+        except Exception as e:
+            # A batch mixes every board's writes; one bad row must only cost its own
+            logger.warning("Drawing batch of %d writes failed, retrying one by one: %s",
+                           len(batch), e)
+        dropped = []
+        for item in batch:
+            try:
+                self._persist([item])
+            except Exception as e:
+                logger.warning("Dropping %s write: %s", item[0], e)
+                dropped.append(item)
+        return dropped
+
+    def _write_dropped(self, item: tuple):
+        """Stop serving cached objects that include a write which never landed"""
+        kind, *args = item
+        if kind == "stroke":
+            board_id = args[0]["board_id"]
+        elif kind == "stroke_points":
+            board_id = self.stroke_owners.get(args[0], (None,))[0]
+        else:
+            return
+        if board_id is not None:
+            self._state_changed(board_id)
+
+    def _persist(self, batch: list):
+        """Group queued writes by table and persist them in one commit"""
+        strokes = []
+        stroke_points = []
+        cursors = {}
+        for kind, *args in batch:
+            if kind == "stroke":
+                strokes.append(args[0])
+            elif kind == "stroke_points":
+                stroke_points.append((args[0], args[1]))
+            elif kind == "cursor":
+                # Only the latest position per user is worth persisting
+                board_id, user_id, x, y, tool = args
+                cursors[(board_id, user_id)] = (x, y, tool)
+        
+        with get_db_session() as db:
+            DatabaseService.write_batch(db, strokes, stroke_points, cursors)
+                
+    def generate_join_code(self) -> str:
+        """Generate a 6-character alphanumeric code"""
+        # One urandom read; base32 maps it to A-Z and 2-7, 5 bits per character
+        return base64.b32encode(os.urandom(5))[:6].decode()
         
     async def create_board(self, ws: WebSocket, client_ip: str = None, user_agent: str = None) -> Optional[dict]:
         """Create a new board and return admin info"""
-        board_id = await self.generate_join_code()
-        if not board_id:
-            return None
-            
         admin_id = secrets.token_urlsafe(16)
         
-        for db in get_db():
+        with get_db_session() as db:
             try:
-                # Create board in database
-                DatabaseService.create_board(db, board_id, admin_id)
+                # Create board in database. 32^6 codes make collisions rare, so
+                # rely on the unique board_id constraint instead of a SELECT
+                # per candidate and only retry when the insert is rejected.
+                board_id = None
+                for _ in range(self.JOIN_CODE_ATTEMPTS):
+                    code = self.generate_join_code()
+                    try:
+                        DatabaseService.create_board(db, code, admin_id)
+                    except IntegrityError:
+                        db.rollback()
+                        continue
+                    board_id = code
+                    break
+                if not board_id:
+                    return None
                 
                 # Generate admin nickname
                 admin_nickname = f"Admin{board_id[:4]}"
@@ -60,6 +420,7 @@ class WebSocketManager:
                 
                 # Get full board state
                 board_state = DatabaseService.get_board_state(db, board_id)
+                self.admin_ids[board_id] = admin_id
                 
                 return {
                     "board_id": board_id,
@@ -70,22 +431,18 @@ class WebSocketManager:
                     "board_state": board_state
                 }
             except Exception as e:
-                print(f"Error creating board: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception("Error creating board: %s", e)
                 return None
-            finally:
-                db.close()
-        return None
 
-    async def join_board(self, board_id: str, ws: WebSocket, user_token: str = None, client_ip: str = None, user_agent: str = None) -> Optional[dict]:
+    async def join_board(self, board_id: str, ws: WebSocket, user_token: str = None, client_ip: str = None, user_agent: str = None,
+                         conn_manager: Optional[ConnectionManager] = None) -> Optional[dict]:
         """Join existing board as user OR rejoin with token"""
-        for db in get_db():
-            try:
+        try:
+            with get_db_session() as db:
                 # Check if board exists
                 board = DatabaseService.get_board(db, board_id)
                 if not board:
-                    return None
+                    return {"error": "not_found"}
                 
                 user_id = None
                 nickname = None
@@ -100,7 +457,6 @@ class WebSocketManager:
                         user_id = validated_user_id
                         is_rejoining = True
                         # Get user info from database
-                        from app.database.models import User
                         user = db.query(User).filter(
                             User.user_id == user_id,
                             User.board_id == board_id
@@ -143,294 +499,455 @@ class WebSocketManager:
                 # Update connection state
                 DatabaseService.update_connection_state(db, board_id, user_id)
 
+                self.admin_ids[board_id] = board.admin_id
                 if user_id == board.admin_id:
                     DatabaseService.cancel_admin_timer(db, board_id)
                 
+            # Waiting on the writer must not hold a pooled connection
+            objects = await self._board_objects(board_id)
+            # Points still held are already in the objects; send them to the
+            # board now, before this user connects, so they arrive only once.
+            # The flush takes them in the same step the objects were copied
+            if conn_manager is not None:
+                await self._flush_events(board_id, conn_manager)
+            
+            with get_db_session() as db:
                 # Get full board state
-                board_state = DatabaseService.get_board_state(db, board_id)
-                
-                return {
-                    "board_id": board_id,
-                    "user_id": user_id,
-                    "token": token_to_send,
-                    "nickname": nickname,
-                    "role": role,
-                    "board_state": board_state
-                }
-            except Exception as e:
-                print(f"❌ Error joining board: {e}")
-                import traceback
-                traceback.print_exc()
-                return None
-            finally:
-                db.close()
-        return None
+                board_state = DatabaseService.get_board_state(db, board_id, objects)
+            
+            return {
+                "board_id": board_id,
+                "user_id": user_id,
+                "token": token_to_send,
+                "nickname": nickname,
+                "role": role,
+                "board_state": board_state
+            }
+        except Exception as e:
+            logger.exception("Error joining board: %s", e)
+            return None
         
+    async def _board_objects(self, board_id: str) -> dict:
+        """Get a board's strokes, shapes, texts and layers, cached until it changes"""
+        # Reuse the objects cached by an earlier read unless the board changed
+        # since; a rebuild must see all queued writes
+        objects = self.state_cache.get(board_id)
+        if objects is None:
+            version = self._state_versions.get(board_id, 0)
+            await self.write_q.join()
+            with get_db_session() as db:
+                objects = DatabaseService.get_board_objects(db, board_id)
+            # A change queued during the wait may be missing from this read
+            if self.cache_state and self._state_versions.get(board_id, 0) == version:
+                self.state_cache[board_id] = objects
+        if objects is None:
+            return objects
+        # Stroke handlers patch the cached objects in place; hand out a copy
+        return {**objects, "strokes": [
+            {**stroke, "points": list(stroke["points"])} for stroke in objects["strokes"]
+        ]}
+
+    def _state_changed(self, board_id: str):
+        """Drop a board's cached objects once a change is written or queued"""
+        self.state_cache.pop(board_id, None)
+        self._state_versions[board_id] = self._state_versions.get(board_id, 0) + 1
+
+    def _patch_state(self, board_id: str) -> Optional[dict]:
+        """Bump a board's version and return its cached objects for the caller to patch"""
+        self._state_versions[board_id] = self._state_versions.get(board_id, 0) + 1
+        return self.state_cache.get(board_id)
+
+    def _cached_stroke(self, objects: dict, stroke_id: str) -> Optional[dict]:
+        """Find a cached stroke, searching from the newest since that is the one being drawn"""
+        for stroke in reversed(objects["strokes"]):
+            if stroke["id"] == stroke_id:
+                return stroke
+        return None
+
+    def _forget_strokes(self, board_id: str):
+        """Stop accepting points for strokes started on a board"""
+        for stroke_id in [s for s, (b, _) in self.stroke_owners.items() if b == board_id]:
+            del self.stroke_owners[stroke_id]
+
     async def handle_drawing(self, board_id: str, user_id: str, data: dict, 
                             conn_manager: ConnectionManager):
         """Handle all drawing and interaction events"""
-        for db in get_db():
-            try:
-                # Verify board exists
-                board = DatabaseService.get_board(db, board_id)
-                if not board:
-                    return
-                    
-                # Update connection heartbeat
-                DatabaseService.update_connection_heartbeat(db, board_id, user_id)
-                
-                # Update board activity
-                DatabaseService.update_board_activity(db, board_id)
-                
-                event_type = data.get("type")
-                
-                # ============= RATE LIMITING =============
-                if event_type == "stroke_points":
-                    points = len(data.get("points", []))
-                    if not DatabaseService.check_rate_limit(db, user_id, board_id, "draw", points):
-                        await conn_manager.send_to_user(board_id, user_id, {
-                            "type": "rate_limit_warning",
-                            "message": "Slow down! You're sending too many points."
-                        })
-                        return
-                elif event_type == "cursor_update":
-                    if not DatabaseService.check_rate_limit(db, user_id, board_id, "cursor", 1):
-                        return
-                
-                # ============= STROKE EVENTS =============
-                if event_type == "stroke_start":
-                    stroke_id = data.get("stroke_id")
-                    stroke_data = data.get("stroke")
-                    
-                    # Check object limit
-                    if board.object_count >= board.max_objects:
-                        await conn_manager.send_to_user(board_id, user_id, {
-                            "type": "error",
-                            "message": "Object limit reached (5000 maximum)"
-                        })
-                        return
-                    
-                    # Add stroke to database
-                    DatabaseService.add_stroke(
-                        db,
-                        stroke_id=stroke_id,
-                        board_id=board_id,
-                        user_id=user_id,
-                        layer_id=stroke_data.get("layer_id", "default"),
-                        brush_type=stroke_data.get("brush_type", "pen"),
-                        color=stroke_data.get("color", "#000000"),
-                        width=stroke_data.get("width", 5)
-                    )
-                    
-                    # Increment object count
-                    DatabaseService.increment_object_count(db, board_id)
-                    
-                    await conn_manager.broadcast_to_board(board_id, {
-                        "type": "stroke_start",
-                        "stroke_id": stroke_id,
-                        "user_id": user_id,
-                        "stroke": {
-                            "layer_id": stroke_data.get("layer_id", "default"),
-                            "brush_type": stroke_data.get("brush_type", "pen"),
-                            "color": stroke_data.get("color", "#000000"),
-                            "width": stroke_data.get("width", 5)
-                        },
-                        "timestamp": time.time()
-                    })
-                        
-                elif event_type == "stroke_points":
-                    stroke_id = data.get("stroke_id")
-                    points_data = data.get("points", [])
-                    
-                    # Add points to database
-                    DatabaseService.add_stroke_points(db, stroke_id, points_data)
-                    
-                    await conn_manager.broadcast_to_board(board_id, {
-                        "type": "stroke_points",
-                        "user_id": user_id,
-                        "stroke_id": stroke_id,
-                        "points": points_data,
-                        "timestamp": time.time()
-                    })
-                    
-                elif event_type == "stroke_end":
-                    stroke_id = data.get("stroke_id")
-                    await conn_manager.broadcast_to_board(board_id, {
-                        "type": "stroke_end",
-                        "stroke_id": stroke_id,
-                        "user_id": user_id,
-                        "timestamp": time.time()
-                    })
-                
-                # ============= SHAPE EVENTS =============
-                elif event_type == "shape_create":
-                    shape_data = data.get("shape")
-                    shape_id = f"shape_{int(time.time() * 1000)}_{user_id}"
-                    
-                    # Check object limit
-                    if board.object_count >= board.max_objects:
-                        await conn_manager.send_to_user(board_id, user_id, {
-                            "type": "error",
-                            "message": "Object limit reached (5000 maximum)"
-                        })
-                        return
-                    
-                    # Prepare shape data for database
-                    shape_dict = {
-                        "user_id": user_id,
-                        "type": shape_data.get("type"),
-                        "start_x": shape_data.get("startX", shape_data.get("start_x")),
-                        "start_y": shape_data.get("startY", shape_data.get("start_y")),
-                        "end_x": shape_data.get("endX", shape_data.get("end_x")),
-                        "end_y": shape_data.get("endY", shape_data.get("end_y")),
-                        "color": shape_data.get("color", "#000000"),
-                        "stroke_width": shape_data.get("strokeWidth", shape_data.get("stroke_width", 5)),
-                        "layer_id": shape_data.get("layer_id", "default")
-                    }
-                    
-                    # Add shape to database
-                    DatabaseService.add_shape(db, shape_id, board_id, shape_dict)
-                    
-                    # Increment object count
-                    DatabaseService.increment_object_count(db, board_id)
-                    
-                    await conn_manager.broadcast_to_board(board_id, {
-                        "type": "shape_create",
-                        "shape_id": shape_id,
-                        "user_id": user_id,
-                        "shape": {
-                            "type": shape_dict["type"],
-                            "start_x": shape_dict["start_x"],
-                            "start_y": shape_dict["start_y"],
-                            "end_x": shape_dict["end_x"],
-                            "end_y": shape_dict["end_y"],
-                            "color": shape_dict["color"],
-                            "stroke_width": shape_dict["stroke_width"],
-                            "layer_id": shape_dict["layer_id"]
-                        },
-                        "timestamp": time.time()
-                    })
-                        
-                # ============= TEXT EVENTS =============
-                elif event_type == "text_create":
-                    text_data = data.get("text")
-                    text_id = f"text_{int(time.time() * 1000)}_{user_id}"
-                    
-                    # Check object limit
-                    if board.object_count >= board.max_objects:
-                        await conn_manager.send_to_user(board_id, user_id, {
-                            "type": "error",
-                            "message": "Object limit reached (5000 maximum)"
-                        })
-                        return
-                    
-                    # Prepare text data for database
-                    text_dict = {
-                        "user_id": user_id,
-                        "text": text_data.get("text", ""),
-                        "x": text_data.get("x", 0),
-                        "y": text_data.get("y", 0),
-                        "color": text_data.get("color", "#000000"),
-                        "layer_id": text_data.get("layer_id", "default"),
-                        "font_size": text_data.get("font_size", 16),
-                        "font_family": text_data.get("font_family", "Arial")
-                    }
-                    
-                    # Add text to database
-                    DatabaseService.add_text(db, text_id, board_id, text_dict)
-                    
-                    # Increment object count
-                    DatabaseService.increment_object_count(db, board_id)
-                    
-                    await conn_manager.broadcast_to_board(board_id, {
-                        "type": "text_create",
-                        "text_id": text_id,
-                        "user_id": user_id,
-                        "text": text_dict,
-                        "timestamp": time.time()
-                    })
-                        
-                # ============= CURSOR EVENTS =============
-                elif event_type == "cursor_update":
-                    x = data.get("x", 0)
-                    y = data.get("y", 0)
-                    tool = data.get("tool", "pen")
-                    
-                    # Update in database
-                    DatabaseService.update_connection_state(db, board_id, user_id, x, y, tool)
-                    
-                    await conn_manager.broadcast_to_board(board_id, {
-                        "type": "cursor_update",
-                        "user_id": user_id,
-                        "x": x,
-                        "y": y,
-                        "tool": tool,
-                        "timestamp": time.time()
-                    }, exclude_user=user_id)
-                    
-                # ============= ADMIN ACTIONS =============
-                elif event_type == "admin_kick":
-                    # Check if user is admin
-                    user = db.query(User).filter(
-                        User.user_id == user_id,
-                        User.board_id == board_id,
-                        User.role == "admin"
-                    ).first()
-                    
-                    if user:
-                        target_user_id = data.get("user_id")
-                        await self._kick_user(board_id, target_user_id, user_id, conn_manager)
-                        
-                elif event_type == "admin_ban":
-                    user = db.query(User).filter(
-                        User.user_id == user_id,
-                        User.board_id == board_id,
-                        User.role == "admin"
-                    ).first()
-                    
-                    if user:
-                        target_user_id = data.get("user_id")
-                        await self._ban_user(board_id, target_user_id, user_id, conn_manager, db)
-                        
-                elif event_type == "admin_end_session":
-                    user = db.query(User).filter(
-                        User.user_id == user_id,
-                        User.board_id == board_id,
-                        User.role == "admin"
-                    ).first()
-                    
-                    if user:
-                        await self._end_session(board_id, user_id, conn_manager, db)
-            finally:
-                db.close()
-                    
+        event_type = data.get("type")
+        
+        # Cursor moves are coalesced per user and flushed on a timer,
+        # so they never touch the database or broadcast from here
+        if event_type == "cursor_update":
+            # Broadcast and queued to the shared writer, so only well-typed values
+            x = _number(data.get("x", 0))
+            y = _number(data.get("y", 0))
+            tool = data.get("tool", "pen")
+            if x is None or y is None or not isinstance(tool, str):
+                return
+            self.latest_cursor[(board_id, user_id)] = (x, y, tool)
+            self._schedule_cursor_flush(conn_manager)
+            return
+        
+        # One timestamp for everything this event touches
+        now = time.time()
+        
+        # Sessions are closed before every await: the pool is fixed, and a
+        # checkout blocking on the loop would stall everything else
+        with get_db_session() as db:
+            # Verify board exists
+            if not DatabaseService.get_board(db, board_id):
+                return
+            
+            # Update connection heartbeat
+            DatabaseService.update_connection_heartbeat(db, board_id, user_id, now)
+            
+            # Update board activity
+            DatabaseService.update_board_activity(db, board_id, now)
+        
+        # Anything else must not overtake the points still being held
+        if event_type != "stroke_points" and board_id in self.pending_events:
+            await self._flush_events(board_id, conn_manager)
+        
+        handler = self._HANDLERS.get(event_type, WebSocketManager._on_unknown)
+        await handler(self, board_id, user_id, data, conn_manager, now)
+
+    def _object_limit_reached(self, db, board_id: str) -> bool:
+        """Check whether a board may hold another object"""
+        board = DatabaseService.get_board(db, board_id)
+        return board is None or board.object_count >= board.max_objects
+
+    def _is_admin(self, board_id: str, user_id: str) -> bool:
+        """Check whether a user is the board admin"""
+        with get_db_session() as db:
+            return db.query(User.id).filter(
+                User.user_id == user_id,
+                User.board_id == board_id,
+                User.role == "admin"
+            ).first() is not None
+
+    async def _on_stroke_start(self, board_id: str, user_id: str, data: dict,
+                               conn_manager: ConnectionManager, now: float):
+        """Start a stroke and announce it to the board"""
+        stroke_id = data.get("stroke_id")
+        stroke_data = data.get("stroke") or {}
+        stroke = _checked_stroke(_mk_stroke(stroke_data)) if isinstance(stroke_data, dict) else None
+
+        # Stroke ids come from clients but are unique across all boards
+        if stroke is None or not _valid_stroke_id(stroke_id) or stroke_id in self.stroke_owners:
+            logger.debug("Rejecting stroke_start with stroke id %r from user %s", stroke_id, user_id)
+            return
+        with get_db_session() as db:
+            if DatabaseService.stroke_exists(db, stroke_id):
+                logger.debug("Rejecting stroke_start with stroke id %r from user %s", stroke_id, user_id)
+                return
+            limit_reached = self._object_limit_reached(db, board_id)
+
+        # Check object limit
+        if limit_reached:
+            await conn_manager.send_to_user(board_id, user_id, {
+                "type": "error",
+                "message": "Object limit reached (5000 maximum)"
+            })
+            return
+
+        # Queue stroke for the background writer
+        await self.write_q.put(("stroke", {
+            "stroke_id": stroke_id,
+            "board_id": board_id,
+            "user_id": user_id,
+            **stroke
+        }))
+        # The writer counts the object in the same commit that stores it
+        self.stroke_owners[stroke_id] = (board_id, user_id)
+        cached = self._patch_state(board_id)
+        if cached is not None:
+            cached["strokes"].append({
+                "id": stroke_id,
+                "user_id": user_id,
+                **stroke,
+                "points": [],
+                "created_at": now
+            })
+
+        await conn_manager.broadcast_to_board(board_id, {
+            "type": "stroke_start",
+            "stroke_id": stroke_id,
+            "user_id": user_id,
+            "stroke": stroke,
+            "timestamp": now
+        })
+
+    async def _on_stroke_points(self, board_id: str, user_id: str, data: dict,
+                                conn_manager: ConnectionManager, now: float):
+        """Append points to a stroke"""
+        stroke_id = data.get("stroke_id")
+        points_data = data.get("points", [])
+        
+        # Empty frames only keep the connection alive, which is already done
+        if not points_data:
+            return
+
+        # Only the author may extend a stroke, and only with well-formed points
+        if self.stroke_owners.get(stroke_id) != (board_id, user_id):
+            return
+        points_data = _mk_points(points_data, now)
+        if points_data is None:
+            logger.debug("Rejecting malformed stroke_points from user %s", user_id)
+            return
+
+        # Check rate limit
+        if not self._draw_limit(board_id, user_id).take(len(points_data)):
+            await conn_manager.send_to_user(board_id, user_id, {
+                "type": "rate_limit_warning",
+                "message": "Slow down! You're sending too many points."
+            })
+            return
+
+        # Queue points for the background writer
+        await self.write_q.put(("stroke_points", stroke_id, points_data))
+        cached = self._patch_state(board_id)
+        if cached is not None:
+            stroke = self._cached_stroke(cached, stroke_id)
+            if stroke is not None:
+                stroke["points"].extend(points_data)
+            else:
+                self._state_changed(board_id)
+        index = self.erase_indexes.get(board_id)
+        if index is not None:
+            index.add(stroke_id, [(p["x"], p["y"]) for p in points_data])
+
+        self._queue_event(board_id, {
+            "type": "stroke_points",
+            "user_id": user_id,
+            "stroke_id": stroke_id,
+            "points": points_data,
+            "timestamp": now
+        }, conn_manager)
+
+    def _draw_limit(self, board_id: str, user_id: str) -> SlidingWindow:
+        """Get or create a user's drawing rate limit window"""
+        limits = self.draw_limits.setdefault(board_id, {})
+        limit = limits.get(user_id)
+        if limit is None:
+            limit = limits[user_id] = SlidingWindow(self.DRAW_RATE_POINTS, self.DRAW_RATE_WINDOW)
+        return limit
+
+    async def _on_stroke_end(self, board_id: str, user_id: str, data: dict,
+                             conn_manager: ConnectionManager, now: float):
+        """Announce the end of a stroke"""
+        stroke_id = data.get("stroke_id")
+        await conn_manager.broadcast_to_board(board_id, {
+            "type": "stroke_end",
+            "stroke_id": stroke_id,
+            "user_id": user_id,
+            "timestamp": now
+        })
+
+    async def _on_shape_create(self, board_id: str, user_id: str, data: dict,
+                               conn_manager: ConnectionManager, now: float):
+        """Create a shape"""
+        shape_id = f"shape_{self._id_prefix}_{next(self._object_ids)}"
+
+        # Prepare shape data for database
+        shape = _mk_shape(data.get("shape") or {})
+        shape_dict = {"user_id": user_id, **shape}
+
+        with get_db_session() as db:
+            # Check object limit
+            limit_reached = self._object_limit_reached(db, board_id)
+            if not limit_reached:
+                # Add shape to database
+                DatabaseService.add_shape(db, shape_id, board_id, shape_dict)
+
+                # Increment object count
+                DatabaseService.increment_object_count(db, board_id)
+        if limit_reached:
+            await conn_manager.send_to_user(board_id, user_id, {
+                "type": "error",
+                "message": "Object limit reached (5000 maximum)"
+            })
+            return
+        self._state_changed(board_id)
+
+        await conn_manager.broadcast_to_board(board_id, {
+            "type": "shape_create",
+            "shape_id": shape_id,
+            "user_id": user_id,
+            "shape": shape,
+            "timestamp": now
+        })
+
+    async def _on_text_create(self, board_id: str, user_id: str, data: dict,
+                              conn_manager: ConnectionManager, now: float):
+        """Create a text object"""
+        text_id = f"text_{self._id_prefix}_{next(self._object_ids)}"
+
+        # Prepare text data for database
+        text_dict = {"user_id": user_id, **_mk_text(data.get("text") or {})}
+
+        with get_db_session() as db:
+            # Check object limit
+            limit_reached = self._object_limit_reached(db, board_id)
+            if not limit_reached:
+                # Add text to database
+                DatabaseService.add_text(db, text_id, board_id, text_dict)
+
+                # Increment object count
+                DatabaseService.increment_object_count(db, board_id)
+        if limit_reached:
+            await conn_manager.send_to_user(board_id, user_id, {
+                "type": "error",
+                "message": "Object limit reached (5000 maximum)"
+            })
+            return
+        self._state_changed(board_id)
+
+        await conn_manager.broadcast_to_board(board_id, {
+            "type": "text_create",
+            "text_id": text_id,
+            "user_id": user_id,
+            "text": text_dict,
+            "timestamp": now
+        })
+
+    async def _on_erase_path(self, board_id: str, user_id: str, data: dict,
+                             conn_manager: ConnectionManager, now: float):
+        """Delete every stroke the eraser path touches, announced in one frame"""
+        points = _mk_points(data.get("points") or [], now)
+        if not points:
+            return
+        eraser_path = [(p["x"], p["y"]) for p in points]
+
+        # Only strokes in grid cells the path passes get the exact hit test
+        index = await self._erase_index(board_id)
+        eraser_xy = np.asarray(eraser_path, dtype=np.float64)
+        erased_ids = [
+            stroke_id for stroke_id in index.near(eraser_path, self.eraser.eraser_width)
+            if self.eraser.hits(index.points(stroke_id), eraser_xy)
+        ]
+        if not erased_ids:
+            return
+
+        # Forget the strokes before waiting, so neither later points nor a
+        # concurrent erase can reach them
+        for stroke_id in erased_ids:
+            index.remove(stroke_id)
+            self.stroke_owners.pop(stroke_id, None)
+        # Queued points of these strokes must land before the strokes go
+        await self.write_q.join()
+        with get_db_session() as db:
+            DatabaseService.delete_strokes(db, board_id, erased_ids)
+        cached = self._patch_state(board_id)
+        if cached is not None:
+            erased = set(erased_ids)
+            cached["strokes"][:] = [s for s in cached["strokes"] if s["id"] not in erased]
+
+        await conn_manager.broadcast_to_board(board_id, {
+            "type": "objects_delete",
+            "object_ids": erased_ids,
+            "user_id": user_id,
+            "timestamp": now
+        })
+
+    async def _erase_index(self, board_id: str) -> StrokeIndex:
+        """Get a board's stroke index, loading it from the database on first use"""
+        index = self.erase_indexes.get(board_id)
+        if index is not None:
+            loading = self._erase_loads.get(board_id)
+            if loading is not None:
+                await loading.wait()
+            return index
+
+        # Registered before loading so points arriving meanwhile are indexed
+        # too; a point both indexed and read back only repeats in the hit test
+        index = StrokeIndex()
+        loading = asyncio.Event()
+        if self.cache_state:
+            self.erase_indexes[board_id] = index
+            self._erase_loads[board_id] = loading
+        try:
+            await self.write_q.join()
+            with get_db_session() as db:
+                stroke_points = DatabaseService.get_stroke_points(db, board_id)
+            for stroke_id, points in stroke_points.items():
+                index.add(stroke_id, points)
+        except Exception:
+            if self.erase_indexes.get(board_id) is index:
+                del self.erase_indexes[board_id]
+            raise
+        finally:
+            if self._erase_loads.get(board_id) is loading:
+                del self._erase_loads[board_id]
+            loading.set()
+        return index
+
+    async def _on_admin_kick(self, board_id: str, user_id: str, data: dict,
+                             conn_manager: ConnectionManager, now: float):
+        """Kick a user if the sender is the board admin"""
+        if self._is_admin(board_id, user_id):
+            target_user_id = data.get("user_id")
+            await self._kick_user(board_id, target_user_id, user_id, conn_manager, now)
+
+    async def _on_admin_ban(self, board_id: str, user_id: str, data: dict,
+                            conn_manager: ConnectionManager, now: float):
+        """Ban a user if the sender is the board admin"""
+        if self._is_admin(board_id, user_id):
+            target_user_id = data.get("user_id")
+            await self._ban_user(board_id, target_user_id, user_id, conn_manager, now)
+
+    async def _on_admin_end_session(self, board_id: str, user_id: str, data: dict,
+                                    conn_manager: ConnectionManager, now: float):
+        """End the session if the sender is the board admin"""
+        if self._is_admin(board_id, user_id):
+            await self._end_session(board_id, user_id, conn_manager, now)
+
+    async def _on_unknown(self, board_id: str, user_id: str, data: dict,
+                          conn_manager: ConnectionManager, now: float):
+        """Ignore event types the server does not handle"""
+        logger.debug("Ignoring %r event from user %s", data.get("type"), user_id)
+
+    # Event type -> handler, built once for the class and looked up per message
+    _HANDLERS = {
+        "stroke_start": _on_stroke_start,
+        "stroke_points": _on_stroke_points,
+        "stroke_end": _on_stroke_end,
+        "shape_create": _on_shape_create,
+        "text_create": _on_text_create,
+        "erase_path": _on_erase_path,
+        "admin_kick": _on_admin_kick,
+        "admin_ban": _on_admin_ban,
+        "admin_end_session": _on_admin_end_session,
+    }
+
     async def disconnect(self, board_id: str, user_id: str):
         """Handle user disconnection"""
-        for db in get_db():
-            try:
-                # Mark user as disconnected in database
-                DatabaseService.disconnect_user(db, user_id, board_id)
-                
-                # Remove active connection
-                DatabaseService.remove_active_connection(db, board_id, user_id)
-                
-                # Get board to check if it's admin
-                board = DatabaseService.get_board(db, board_id)
-                if board and user_id == board.admin_id:
-                    # Admin disconnected - create timer
-                    DatabaseService.create_admin_timer(db, board_id)
-            finally:
-                db.close()
+        with get_db_session() as db:
+            # Mark user as disconnected in database
+            DatabaseService.disconnect_user(db, user_id, board_id)
+            
+            # Remove active connection
+            DatabaseService.remove_active_connection(db, board_id, user_id)
+            
+            if user_id == self.admin_ids.get(board_id):
+                # Admin disconnected - create timer
+                DatabaseService.create_admin_timer(db, board_id)
+            
+            # Nobody left to join from the cache until the next rebuild
+            if not DatabaseService.get_active_connections_count(db, board_id):
+                self.state_cache.pop(board_id, None)
+                self.draw_limits.pop(board_id, None)
+                self.erase_indexes.pop(board_id, None)
+                self._forget_strokes(board_id)
 
     async def _kick_user(self, board_id: str, target_user_id: str, admin_id: str,
-                        conn_manager: ConnectionManager):
+                        conn_manager: ConnectionManager, now: float = None):
         """Kick a user from the board"""
+        now = now or time.time()
         # Send kick message to target user
         await conn_manager.send_to_user(board_id, target_user_id, {
             "type": "kicked",
             "reason": "kicked_by_admin",
             "admin_id": admin_id,
-            "timestamp": time.time()
+            "timestamp": now
         })
         
         # Disconnect the user
@@ -441,55 +958,59 @@ class WebSocketManager:
             "type": "user_kicked",
             "user_id": target_user_id,
             "admin_id": admin_id,
-            "timestamp": time.time()
+            "timestamp": now
         })
 
     async def _ban_user(self, board_id: str, target_user_id: str, admin_id: str,
-                       conn_manager: ConnectionManager, db):
+                       conn_manager: ConnectionManager, now: float = None):
         """Ban a user from the board"""
-        # Get user's token and ban it
-        user_tokens = db.query(UserToken).filter(
-            UserToken.user_id == target_user_id,
-            UserToken.board_id == board_id
-        ).all()
-        
-        for token in user_tokens:
-            DatabaseService.revoke_user_token(db, token.token)
+        now = now or time.time()
+        with get_db_session() as db:
+            # Get user's token and ban it
+            user_tokens = db.query(UserToken).filter(
+                UserToken.user_id == target_user_id,
+                UserToken.board_id == board_id
+            ).all()
+            
+            for token in user_tokens:
+                DatabaseService.revoke_user_token(db, token.token)
         
         # Kick the user
-        await self._kick_user(board_id, target_user_id, admin_id, conn_manager)
+        await self._kick_user(board_id, target_user_id, admin_id, conn_manager, now)
         
         # Notify others
         await conn_manager.broadcast_to_board(board_id, {
             "type": "user_banned",
             "user_id": target_user_id,
             "admin_id": admin_id,
-            "timestamp": time.time()
+            "timestamp": now
         })
 
     async def _end_session(self, board_id: str, admin_id: str,
-                          conn_manager: ConnectionManager, db):
+                          conn_manager: ConnectionManager, now: float = None):
         """End session for all users"""
-        # Get all active users
-        active_users = DatabaseService.get_active_users(db, board_id)
-        
-        # Send end session message to all
+        with get_db_session() as db:
+            active_users = DatabaseService.end_board_session(db, board_id)
+        await self._session_ended(board_id, admin_id, active_users, conn_manager, now)
+
+    async def _session_ended(self, board_id: str, admin_id: str, active_users: List[str],
+                             conn_manager: ConnectionManager, now: float = None):
+        """Tell the users of an ended session and drop the board's in-memory state"""
+        now = now or time.time()
+        # Send end session message to all, encoded once for every recipient
+        payload = encode_message({
+            "type": "session_ended",
+            "reason": "ended_by_admin",
+            "admin_id": admin_id,
+            "timestamp": now
+        })
         for user_id in active_users:
             if user_id != admin_id:
-                await conn_manager.send_to_user(board_id, user_id, {
-                    "type": "session_ended",
-                    "reason": "ended_by_admin",
-                    "admin_id": admin_id,
-                    "timestamp": time.time()
-                })
-        
-        # Deactivate board
-        DatabaseService.deactivate_board(db, board_id)
-        
-        # Clear all active connections
-        from app.database.models import ActiveConnection
-        db.query(ActiveConnection).filter(
-            ActiveConnection.board_id == board_id
-        ).delete()
+                await conn_manager.send_to_user(board_id, user_id, payload)
         
-        db.commit()
+        self.state_cache.pop(board_id, None)
+        self._state_versions.pop(board_id, None)
+        self.draw_limits.pop(board_id, None)
+        self.admin_ids.pop(board_id, None)
+        self.erase_indexes.pop(board_id, None)
+        self._forget_strokes(board_id)
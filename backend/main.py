@@ -1,35 +1,76 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from starlette.websockets import WebSocketState
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import asyncio
+import heapq
+import os
+import logging
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 from app.ws.websocket_manager import WebSocketManager
 from app.ws.connection_manager import ConnectionManager
-from app.database import init_db, DatabaseService
+from app.database import init_db, get_db_session, DatabaseService
+from app.core.logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# Bound once so the per-frame helpers skip the module attribute lookup
+_dumps = orjson.dumps
+_loads = orjson.loads
+
+# Unchanging payloads, built once
+_ADMIN_COUNTDOWN_BYTES = _dumps({
+    "type": "admin_disconnect_countdown",
+    "seconds_remaining": 600
+})
+_ERROR_MESSAGES = {
+    "not_found": "Board not found. Please check the code and try again.",
+    "banned": "You are banned from this board",
+    "timeout": "You are timed out from this board",
+    "full": "Board is full (10 users maximum)"
+}
+# Largest client frame accepted; drawing frames are a few KB, this leaves
+# room for point batches held back while the client's socket was busy
+MAX_FRAME_SIZE = 64 * 1024
+# Welcome frames are this prefix spliced onto the encoded board info
+_WELCOME_PREFIX = b'{"type":"welcome",'
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    print("Starting Drawing API...")
+    app.state.log_listener = setup_logging()
+    logger.info("Starting Drawing API...")
     init_db()
     
-    # Initialize managers
-    app.state.ws_manager = WebSocketManager()
-    app.state.conn_manager = ConnectionManager()
+    # Initialize managers; REDIS_URL shares broadcasts between workers
+    redis_url = os.getenv("REDIS_URL")
+    # Blocking SQLite calls of the drawing writer and the background jobs run
+    # here, off the event loop
+    app.state.db_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sqlite")
+    app.state.ws_manager = WebSocketManager(cache_state=not redis_url)
+    app.state.conn_manager = ConnectionManager(redis_url)
+    app.state.ws_manager.start(app.state.db_executor)
     
-    # Start background tasks
-    app.state.cleanup_task = asyncio.create_task(cleanup_stale_connections(app))
-    app.state.admin_timer_task = asyncio.create_task(check_admin_timers(app))
-    
-    print("Ready to accept connections")
-    yield
-    
-    # Shutdown
-    print("Shutting down Drawing API...")
-    app.state.cleanup_task.cancel()
-    app.state.admin_timer_task.cancel()
+    # Start background tasks; leaving the group awaits them and the executor
+    # shutdown below waits out a job thread they were awaiting, so no job is
+    # still mid-session once the connection manager closes
+    async with asyncio.TaskGroup() as tasks:
+        app.state.background_task = tasks.create_task(run_background_jobs(app))
+        
+        logger.info("Ready to accept connections")
+        yield
+        
+        # Shutdown
+        logger.info("Shutting down Drawing API...")
+        app.state.background_task.cancel()
+    # The writer drains through the executor, so stop it first
+    await app.state.ws_manager.stop()
+    await asyncio.to_thread(app.state.db_executor.shutdown)
+    await app.state.conn_manager.close()
+    app.state.log_listener.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -42,60 +83,82 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-async def cleanup_stale_connections(app: FastAPI):
-    """Background task to clean up stale connections"""
-    while True:
-        try:
-            await asyncio.sleep(30)
-            from app.database import get_db
-            for db in get_db():
-                try:
-                    DatabaseService.cleanup_stale_connections(db, timeout_seconds=30)
-                finally:
-                    db.close()
-                break
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            print(f"Error in cleanup_stale_connections: {e}")
+# Periodic background jobs and their intervals in seconds
+BACKGROUND_JOBS = {"stale_connections": 30, "admin_timers": 60}
 
-async def check_admin_timers(app: FastAPI):
-    """Background task to check for expired admin timers"""
+async def run_background_jobs(app: FastAPI):
+    """Background task running the periodic jobs off one deadline heap"""
+    loop = asyncio.get_running_loop()
+    deadlines = [(loop.time() + interval, job) for job, interval in BACKGROUND_JOBS.items()]
+    heapq.heapify(deadlines)
     while True:
         try:
-            await asyncio.sleep(60)
-            from app.database import get_db
-            for db in get_db():
-                try:
-                    expired_timers = DatabaseService.get_expired_admin_timers(db)
-                    for timer in expired_timers:
-                        ws_manager = app.state.ws_manager
-                        conn_manager = app.state.conn_manager
-                        await ws_manager._end_session(timer.board_id, "system", conn_manager, db)
-                        DatabaseService.cancel_admin_timer(db, timer.board_id)
-                        print(f"Session auto-ended for board {timer.board_id} (admin timeout)")
-                finally:
-                    db.close()
-                break
+            await asyncio.sleep(max(0, deadlines[0][0] - loop.time()))
+            now = loop.time()
+            due = set()
+            while deadlines[0][0] <= now:
+                job = heapq.heappop(deadlines)[1]
+                due.add(job)
+                heapq.heappush(deadlines, (now + BACKGROUND_JOBS[job], job))
+
+            ended = await loop.run_in_executor(app.state.db_executor, run_due_jobs, due)
+            for board_id, active_users in ended:
+                await app.state.ws_manager._session_ended(
+                    board_id, "system", active_users, app.state.conn_manager
+                )
+                logger.info("Session auto-ended for board %s (admin timeout)", board_id)
         except asyncio.CancelledError:
             break
         except Exception as e:
-            print(f"Error in check_admin_timers: {e}")
+            logger.exception("Error in background jobs: %s", e)
+
+def run_due_jobs(due: set) -> List[Tuple[str, List[str]]]:
+    """Database work of the due jobs, run on an executor thread in a session of its own"""
+    ended = []
+    # One session per wake covers every job that came due together
+    with get_db_session() as db:
+        if "stale_connections" in due:
+            DatabaseService.cleanup_stale_connections(db, 30)
+        if "admin_timers" in due:
+            # End the sessions whose admin disconnect timer has expired
+            for timer in DatabaseService.get_expired_admin_timers(db):
+                board_id = timer.board_id
+                ended.append((board_id, DatabaseService.end_board_session(db, board_id)))
+                DatabaseService.cancel_admin_timer(db, board_id)
+    return ended
 
 # Helper function to get client info
 def get_client_info(websocket: WebSocket) -> tuple:
     """Extract client IP and user agent from WebSocket"""
-    client_ip = None
-    user_agent = None
-    
-    if hasattr(websocket, 'client'):
-        client_ip = websocket.client.host
-    elif 'x-forwarded-for' in websocket.headers:
-        client_ip = websocket.headers['x-forwarded-for'].split(',')[0]
+    headers = websocket.headers
+    client = websocket.client
+    if client:
+        client_ip = client.host
+    else:
+        # First hop of the forwarded chain, without splitting the whole header
+        client_ip = headers.get('x-forwarded-for', '').partition(',')[0] or None
     
-    user_agent = websocket.headers.get('user-agent')
-    
-    return client_ip, user_agent
+    return client_ip, headers.get('user-agent')
+
+async def receive_message(websocket: WebSocket) -> dict:
+    """Receive the next client frame within MAX_FRAME_SIZE and parse it with orjson"""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        raw = message.get("text") or message.get("bytes")
+        # Skip oversized frames before paying for the parse
+        if len(raw) <= MAX_FRAME_SIZE:
+            return _loads(raw)
+        logger.warning("Skipping %d byte frame over the size limit", len(raw))
+
+async def send_message(websocket: WebSocket, message: dict):
+    """Encode a direct reply with orjson, framed like broadcasts"""
+    await websocket.send_bytes(_dumps(message))
+
+def welcome_payload(board_info: dict) -> bytes:
+    """Encode a welcome frame without copying board_info into a new dict"""
+    return _WELCOME_PREFIX + _dumps(board_info)[1:]
 
 @app.get("/")
 async def root():
@@ -105,6 +168,22 @@ async def root():
 async def health():
     return {"status": "healthy", "database": "sqlite"}
 
+async def cleanup_user(board_id: str, user_id: str, ws_manager: WebSocketManager,
+                       conn_manager: ConnectionManager, was_admin: bool = False):
+    """Drop a disconnected user and tell the rest of the board"""
+    remaining = await conn_manager.disconnect(board_id, user_id)
+    await ws_manager.disconnect(board_id, user_id)
+    # The last socket on the board has nobody to tell, unless Redis may
+    # still deliver to sockets held by other workers
+    if not remaining and conn_manager.redis is None:
+        return
+    await conn_manager.broadcast_bytes(board_id, _dumps({
+        "type": "user_left",
+        "user_id": user_id
+    }))
+    if was_admin or ws_manager.admin_ids.get(board_id) == user_id:
+        await conn_manager.broadcast_bytes(board_id, _ADMIN_COUNTDOWN_BYTES)
+
 @app.websocket("/ws/create")
 async def websocket_create_endpoint(websocket: WebSocket):
     """WebSocket endpoint for creating a new board"""
@@ -130,50 +209,28 @@ async def websocket_create_endpoint(websocket: WebSocket):
         user_id = board_info["user_id"]
         
         # Store WebSocket connection
-        await conn_manager.connect(board_id, user_id, websocket)
+        await conn_manager.connect(board_id, user_id, websocket,
+                                   binary=websocket.query_params.get("binary") == "1")
         
         # Send welcome message
-        await websocket.send_json({
-            "type": "welcome",
-            **board_info
-        })
+        await websocket.send_bytes(welcome_payload(board_info))
 
         
-        print(f"Board created: {board_id}, Admin: {user_id}")
+        logger.info("Board created: %s, Admin: %s", board_id, user_id)
         
         # Main message loop
         while True:
-            data = await websocket.receive_json()
+            data = await receive_message(websocket)
             await ws_manager.handle_drawing(board_id, user_id, data, conn_manager)
             
     except WebSocketDisconnect:
-        print(f"Admin disconnected: board={board_id}, user={user_id}")
+        logger.info("Admin disconnected: board=%s, user=%s", board_id, user_id)
         if board_id and user_id:
-            await conn_manager.disconnect(board_id, user_id)
-            await ws_manager.disconnect(board_id, user_id)
-            await conn_manager.broadcast_to_board(board_id, {
-                "type": "user_left",
-                "user_id": user_id
-            })
-            await conn_manager.broadcast_to_board(board_id, {
-                "type": "admin_disconnect_countdown",
-                "seconds_remaining": 600
-            })
+            await cleanup_user(board_id, user_id, ws_manager, conn_manager, was_admin=True)
     except Exception as e:
-        print(f"WebSocket error in create: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("WebSocket error in create: %s", e)
         if board_id and user_id:
-            await conn_manager.disconnect(board_id, user_id)
-            await ws_manager.disconnect(board_id, user_id)
-            await conn_manager.broadcast_to_board(board_id, {
-                "type": "user_left",
-                "user_id": user_id
-            })
-            await conn_manager.broadcast_to_board(board_id, {
-                "type": "admin_disconnect_countdown",
-                "seconds_remaining": 600
-            })
+            await cleanup_user(board_id, user_id, ws_manager, conn_manager, was_admin=True)
         try:
             await websocket.close()
         except Exception:
@@ -193,41 +250,15 @@ async def websocket_join_endpoint(websocket: WebSocket, board_id: str):
         # Get client info
         client_ip, user_agent = get_client_info(websocket)
         
-        # Check if board exists first
-        from app.database import get_db
-        board_exists = False
-        for db in get_db():
-            try:
-                board = DatabaseService.get_board(db, board_id)
-                if not board:
-                    print(f"Board not found: {board_id}")
-                    await websocket.send_json({
-                        "type": "error",
-                        "message": "Board not found. Please check the code and try again."
-                    })
-                    await websocket.close(code=1008, reason="Board not found")
-                    return
-                board_exists = True
-            finally:
-                db.close()
-            break
-        
-        if not board_exists:
-            await websocket.close(code=1008, reason="Database error")
-            return
-        
         user_token = websocket.query_params.get("token")
-        if websocket.client_state != WebSocketState.CONNECTED:
-            return
-        
         # Join existing board
         board_info = await ws_manager.join_board(
-            board_id, websocket, user_token, client_ip, user_agent
+            board_id, websocket, user_token, client_ip, user_agent, conn_manager
         )
         
         if not board_info:
-            print(f"Failed to join board: {board_id}")
-            await websocket.send_json({
+            logger.warning("Failed to join board: %s", board_id)
+            await send_message(websocket, {
                 "type": "error",
                 "message": "Failed to join board. It may be full or inactive."
             })
@@ -236,14 +267,9 @@ async def websocket_join_endpoint(websocket: WebSocket, board_id: str):
         
         # Check for specific errors
         if "error" in board_info:
-            error_messages = {
-                "banned": "You are banned from this board",
-                "timeout": "You are timed out from this board",
-                "full": "Board is full (10 users maximum)"
-            }
-            error_msg = error_messages.get(board_info["error"], "Cannot join board")
-            print(f"Join rejected for {board_id}: {board_info['error']}")
-            await websocket.send_json({
+            error_msg = _ERROR_MESSAGES.get(board_info["error"], "Cannot join board")
+            logger.info("Join rejected for %s: %s", board_id, board_info["error"])
+            await send_message(websocket, {
                 "type": "error",
                 "message": error_msg
             })
@@ -253,95 +279,68 @@ async def websocket_join_endpoint(websocket: WebSocket, board_id: str):
         user_id = board_info["user_id"]
         
         # Store WebSocket connection
-        await conn_manager.connect(board_id, user_id, websocket)
+        await conn_manager.connect(board_id, user_id, websocket,
+                                   binary=websocket.query_params.get("binary") == "1")
         
         # Send welcome message
-        if websocket.client_state != WebSocketState.CONNECTED:
-            await conn_manager.disconnect(board_id, user_id)
-            return
         try:
-            await websocket.send_json({
-                "type": "welcome",
-                **board_info
-            })
+            await websocket.send_bytes(welcome_payload(board_info))
         except Exception as e:
-            print(f"Welcome send failed: board={board_id}, user={user_id}, err={e}")
+            logger.warning("Welcome send failed: board=%s, user=%s, err=%s", board_id, user_id, e)
+            # The send is the only reliable check that the peer is still there;
+            # undo the join so the user is not left marked as connected
             await conn_manager.disconnect(board_id, user_id)
+            await ws_manager.disconnect(board_id, user_id)
             return
         
-        await conn_manager.broadcast_to_board(board_id, {
+        await conn_manager.broadcast_bytes(board_id, _dumps({
             "type": "user_joined",
             "user_id": user_id,
             "nickname": board_info.get("nickname"),
             "role": board_info.get("role", "user")
-        }, exclude_user=user_id)
+        }), exclude_user=user_id)
 
         if board_info.get("role") == "admin":
-            await conn_manager.broadcast_to_board(board_id, {
+            await conn_manager.broadcast_bytes(board_id, _dumps({
                 "type": "admin_reconnected"
-            }, exclude_user=user_id)
+            }), exclude_user=user_id)
 
-        print(f"User joined board: {board_id}, User: {board_info['nickname']} ({user_id})")
+        logger.info("User joined board: %s, User: %s (%s)", board_id, board_info["nickname"], user_id)
         
         # Main message loop
         while True:
-            data = await websocket.receive_json()
+            data = await receive_message(websocket)
             await ws_manager.handle_drawing(board_id, user_id, data, conn_manager)
             
     except WebSocketDisconnect:
-        print(f"User disconnected: board={board_id}, user={user_id}")
+        logger.info("User disconnected: board=%s, user=%s", board_id, user_id)
         if user_id:
-            await conn_manager.disconnect(board_id, user_id)
-            await ws_manager.disconnect(board_id, user_id)
-            await conn_manager.broadcast_to_board(board_id, {
-                "type": "user_left",
-                "user_id": user_id
-            })
-            is_admin = False
-            from app.database import get_db
-            for db in get_db():
-                try:
-                    board = DatabaseService.get_board(db, board_id)
-                    if board and board.admin_id == user_id:
-                        is_admin = True
-                finally:
-                    db.close()
-                break
-            if is_admin:
-                await conn_manager.broadcast_to_board(board_id, {
-                    "type": "admin_disconnect_countdown",
-                    "seconds_remaining": 600
-                })
+            await cleanup_user(board_id, user_id, ws_manager, conn_manager)
     except Exception as e:
-        print(f"WebSocket error in join: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("WebSocket error in join: %s", e)
         if user_id:
-            await conn_manager.disconnect(board_id, user_id)
-            await ws_manager.disconnect(board_id, user_id)
-            await conn_manager.broadcast_to_board(board_id, {
-                "type": "user_left",
-                "user_id": user_id
-            })
-            is_admin = False
-            from app.database import get_db
-            for db in get_db():
-                try:
-                    board = DatabaseService.get_board(db, board_id)
-                    if board and board.admin_id == user_id:
-                        is_admin = True
-                finally:
-                    db.close()
-                break
-            if is_admin:
-                await conn_manager.broadcast_to_board(board_id, {
-                    "type": "admin_disconnect_countdown",
-                    "seconds_remaining": 600
-                })
+            await cleanup_user(board_id, user_id, ws_manager, conn_manager)
         try:
             await websocket.close()
         except Exception:
             pass
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    reload = os.getenv("UVICORN_RELOAD") == "1"
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        # Reload and extra workers re-import the app from its import string;
+        # otherwise serve the already imported app in this process
+        "main:app" if reload or workers > 1 else app,
+        host="0.0.0.0",
+        port=8000,
+        reload=reload,
+        # uvloop where uvicorn[standard] installs it (not on Windows), else
+        # asyncio; Cython HTTP parser from the same extra
+        loop="auto",
+        http="httptools",
+        ws="websockets",
+        # Frames past this are refused by the protocol layer before parsing
+        ws_max_size=MAX_FRAME_SIZE,
+        workers=workers
+    )
@@ -268,6 +268,14 @@ export const useBoardWebSocketHandler = ({
         setObjectCount(prev => Math.max(0, prev - 1));
         break;
 
+      case 'objects_delete': {
+        const deletedIds = new Set<string>(message.object_ids);
+        setStrokes(prev => prev.filter(stroke => !deletedIds.has(stroke.id)));
+        setShapes(prev => prev.filter(shape => !deletedIds.has(shape.id)));
+        setTextObjects(prev => prev.filter(text => !deletedIds.has(text.id)));
+        setObjectCount(prev => Math.max(0, prev - deletedIds.size));
+        break;
+      }
       case 'cursor_update':
         setUsers(prev => prev.map(user => {
           if (user.id === message.user_id) {
@@ -282,6 +290,23 @@ export const useBoardWebSocketHandler = ({
         }));
         break;
 
+      case 'cursor_batch': {
+        const cursors = new Map<string, any>();
+        message.cursors.forEach((cursor: any) => cursors.set(cursor.user_id, cursor));
+        setUsers(prev => prev.map(user => {
+          const cursor = cursors.get(user.id);
+          if (cursor) {
+            return {
+              ...user,
+              cursorX: cursor.x,
+              cursorY: cursor.y,
+              activeTool: cursor.tool
+            };
+          }
+          return user;
+        }));
+        break;
+      }
       case 'session_ended':
         alert('Session has been ended by the admin.');
         handleCompleteDisconnect();
@@ -13,6 +13,54 @@ interface Action {
     timestamp: number;
 }
 
+const STROKE_POINTS_RECORD = 1;
+const JSON_FRAME_START = 0x7b; // '{'
+const textDecoder = new TextDecoder();
+
+// Binary frames are stroke_points records back to back (little-endian):
+// kind u8, stroke id (u16 length + utf-8), user id (u16 length + utf-8),
+// timestamp f64, count u32, then count int16 xs, int16 ys and uint8 pressures
+const decodeBinaryFrame = (buffer: ArrayBuffer): WebSocketMessage[] => {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+    const messages: WebSocketMessage[] = [];
+    let offset = 0;
+
+    const readString = () => {
+        const length = view.getUint16(offset, true);
+        offset += 2;
+        const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+        offset += length;
+        return value;
+    };
+
+    while (offset < buffer.byteLength) {
+        const kind = view.getUint8(offset);
+        offset += 1;
+        if (kind !== STROKE_POINTS_RECORD) break;
+
+        const strokeId = readString();
+        const userId = readString();
+        const timestamp = view.getFloat64(offset, true);
+        const count = view.getUint32(offset + 8, true);
+        offset += 12;
+
+        const points: Point[] = [];
+        for (let i = 0; i < count; i++) {
+            points.push({
+                x: view.getInt16(offset + i * 2, true),
+                y: view.getInt16(offset + (count + i) * 2, true),
+                pressure: bytes[offset + count * 4 + i] / 255,
+                timestamp: timestamp * 1000
+            });
+        }
+        offset += count * 5;
+
+        messages.push({ type: 'stroke_points', stroke_id: strokeId, user_id: userId, points, timestamp });
+    }
+    return messages;
+};
+
 export const useDrawingWebSocket = (
     boardId: string | null,
     userId: string,
@@ -70,10 +118,11 @@ export const useDrawingWebSocket = (
         // Use different endpoints for create vs join
         let wsUrl: string;
         if (isCreating) {
-            wsUrl = `${protocol}//${host}:${port}/ws/create`;
+            wsUrl = `${protocol}//${host}:${port}/ws/create?binary=1`;
         } else if (boardId) {
-            const tokenParam = userToken ? `?token=${encodeURIComponent(userToken)}` : '';
-            wsUrl = `${protocol}//${host}:${port}/ws/join/${boardId}${tokenParam}`;
+            // binary=1 asks for stroke points as compact binary frames
+            const tokenParam = userToken ? `&token=${encodeURIComponent(userToken)}` : '';
+            wsUrl = `${protocol}//${host}:${port}/ws/join/${boardId}?binary=1${tokenParam}`;
         } else {
             console.error('Cannot connect: no board ID and not creating');
             return;
@@ -81,6 +130,7 @@ export const useDrawingWebSocket = (
 
         console.log('Connecting to:', wsUrl);
         const ws = new WebSocket(wsUrl);
+        ws.binaryType = 'arraybuffer';
         wsRef.current = ws;
 
         ws.onopen = () => {
@@ -89,8 +139,19 @@ export const useDrawingWebSocket = (
         };
 
         ws.onmessage = (event) => {
+            let raw = event.data;
+            if (raw instanceof ArrayBuffer) {
+                // JSON arrives in binary frames too; packed records never start with '{'
+                const bytes = new Uint8Array(raw);
+                if (bytes[0] !== JSON_FRAME_START) {
+                    decodeBinaryFrame(raw).forEach((message) => onMessage(message));
+                    return;
+                }
+                raw = textDecoder.decode(bytes);
+            }
+
             try {
-                const data = JSON.parse(event.data);
+                const data = JSON.parse(raw);
                 console.log('WebSocket message received:', data.type);
 
                 // Track actions for undo/redo
@@ -104,7 +165,12 @@ export const useDrawingWebSocket = (
                     setRedoStack([]); // Clear redo stack on new action
                 }
 
-                onMessage(data);
+                // Coalesced frames carry several events in arrival order
+                if (data.type === 'multi') {
+                    data.events.forEach((event: any) => onMessage(event));
+                } else {
+                    onMessage(data);
+                }
             } catch (error) {
                 console.error('Failed to parse WebSocket message:', error);
             }